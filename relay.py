@@ -9,12 +9,12 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import heapq
 import json
 import os
 import random
 import string
-import time
-from collections import defaultdict, deque
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from pathlib import Path
@@ -23,7 +23,22 @@ from typing import Optional
 from websockets.asyncio.server import serve
 from websockets.exceptions import ConnectionClosed
 
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+# Only used to parse incoming control messages.
+json_loads = orjson.loads if orjson is not None else json.loads
+
+try:
+    import uvloop
+except ImportError:  # optional speedup
+    uvloop = None
+
 ROOM_ID_ALPHABET = string.ascii_lowercase + string.digits
+RATE_LIMIT_MAX_IPS = 100_000
+_ROOM_ID_BYTES = ROOM_ID_ALPHABET.encode("ascii")
 
 
 def env_int(name: str, default: int) -> int:
@@ -36,7 +51,46 @@ def env_int(name: str, default: int) -> int:
         return default
 
 
-@dataclass
+# Pre-serialized control messages. Room and peer ids are [a-z0-9_] only, so
+# they can be spliced in without JSON escaping.
+def _error_msg(reason: str) -> str:
+    return f'{{"type":"ERROR","reason":"{reason}"}}'
+
+
+ERR_RATE_LIMITED = _error_msg("rate_limited")
+ERR_INVALID_REQUEST = _error_msg("invalid_request")
+ERR_TOO_MANY_ROOMS = _error_msg("too_many_rooms")
+ERR_ROOM_NOT_FOUND = _error_msg("room_not_found")
+ERR_SENDER_DISCONNECTED = _error_msg("sender_disconnected")
+ERR_ROOM_BUSY = _error_msg("room_busy")
+
+
+def room_created_msg(room_id: str) -> str:
+    return f'{{"type":"ROOM_CREATED","room_id":"{room_id}"}}'
+
+
+def room_joined_msg(room_id: str) -> str:
+    return f'{{"type":"ROOM_JOINED","room_id":"{room_id}"}}'
+
+
+def peer_joined_msg(peer_id: str) -> str:
+    return f'{{"type":"PEER_JOINED","peer_id":"{peer_id}"}}'
+
+
+def peer_disconnected_msg(peer_id: str) -> str:
+    return f'{{"type":"PEER_DISCONNECTED","peer_id":"{peer_id}"}}'
+
+
+def is_valid_room_id(room_id: str) -> bool:
+    # translate() deletes every allowed byte; anything left over is invalid.
+    return (
+        len(room_id) == 6
+        and room_id.isascii()
+        and not room_id.encode("ascii").translate(None, _ROOM_ID_BYTES)
+    )
+
+
+@dataclass(slots=True)
 class Config:
     host: str = os.getenv("RELAY_HOST", "0.0.0.0")
     port: int = env_int("RELAY_PORT", 9784)
@@ -45,10 +99,11 @@ class Config:
     max_msg_size: int = env_int("RELAY_MAX_MSG_SIZE", 10 * 1024 * 1024)
     rate_limit_max: int = env_int("RELAY_RATE_LIMIT_MAX", 20)
     rate_limit_window: int = env_int("RELAY_RATE_LIMIT_WINDOW", 60)
+    max_waiters: int = env_int("RELAY_MAX_WAITERS", 8)
     log_dir: str = os.getenv("RELAY_LOG_DIR", "logs")
 
 
-@dataclass
+@dataclass(slots=True)
 class Connection:
     conn_id: str
     ws: any
@@ -56,12 +111,15 @@ class Connection:
     relay_done: asyncio.Event = field(default_factory=asyncio.Event)
 
 
-@dataclass
+@dataclass(slots=True)
 class Room:
     room_id: str
     sender: Connection
     created_at: float
-    receiver_queue: asyncio.Queue[Connection] = field(default_factory=asyncio.Queue)
+    pending: deque[Connection] = field(default_factory=deque)
+    has_waiter: asyncio.Event = field(default_factory=asyncio.Event)
+    # Joins that passed the max_waiters check but are not in pending yet.
+    reserved: int = 0
     active_receiver: Optional[Connection] = None
     closed: bool = False
 
@@ -110,32 +168,27 @@ class RelayServer:
     def __init__(self, cfg: Config):
         self.cfg = cfg
         self.rooms: dict[str, Room] = {}
-        self.rooms_lock = asyncio.Lock()
-        self.rate_limit: dict[str, deque[float]] = defaultdict(deque)
-        self.rate_limit_lock = asyncio.Lock()
+        # (expires_at, room_id); entries for rooms closed early are skipped lazily
+        self._expiry_heap: list[tuple[float, str]] = []
+        # Set by create_room when a new room expires before the cleanup loop's next wake.
+        self._expiry_wakeup = asyncio.Event()
+        self._next_wake = float("inf")
+        # ip -> (prev_count, curr_count, curr_window_index), ordered by last access
+        self.rate_limit: OrderedDict[str, tuple[int, int, int]] = OrderedDict()
         self.stats = StatsTracker(cfg.log_dir)
 
-    async def send_json(self, conn: Connection, obj: dict) -> bool:
+    async def send_raw(self, conn: Connection, raw: str) -> bool:
         try:
-            body = json.dumps(obj, ensure_ascii=False)
-            if len(body.encode("utf-8")) > self.cfg.max_msg_size:
-                return False
-            await conn.ws.send(body)
+            await conn.ws.send(raw)
             return True
         except Exception:
             return False
 
     async def recv_json(self, conn: Connection) -> Optional[dict]:
         try:
+            # serve(max_size=...) already rejects oversize frames.
             msg = await conn.ws.recv()
-            if isinstance(msg, bytes):
-                if len(msg) > self.cfg.max_msg_size:
-                    return None
-                msg = msg.decode("utf-8")
-            else:
-                if len(msg.encode("utf-8")) > self.cfg.max_msg_size:
-                    return None
-            return json.loads(msg)
+            return json_loads(msg)
         except Exception:
             return None
 
@@ -148,78 +201,95 @@ class RelayServer:
         except Exception:
             pass
 
-    async def is_rate_limited(self, ip: str) -> bool:
-        now = time.time()
+    def is_rate_limited(self, ip: str, now: float) -> bool:
         window = self.cfg.rate_limit_window
-        limit = self.cfg.rate_limit_max
-        async with self.rate_limit_lock:
-            q = self.rate_limit[ip]
-            cutoff = now - window
-            while q and q[0] < cutoff:
-                q.popleft()
-            if len(q) >= limit:
-                return True
-            q.append(now)
+        if window <= 0:
+            # A non-positive window disables rate limiting.
             return False
+        limit = self.cfg.rate_limit_max
+        widx = int(now // window)
+        prev, curr, idx = self.rate_limit.get(ip, (0, 0, widx))
+        if idx != widx:
+            # Roll over; anything older than the previous window no longer counts.
+            prev = curr if widx - idx == 1 else 0
+            curr = 0
+        estimated = prev * (1 - (now - widx * window) / window) + curr
+        limited = estimated >= limit
+        self.rate_limit[ip] = (prev, curr if limited else curr + 1, widx)
+        self.rate_limit.move_to_end(ip)
+        while len(self.rate_limit) > RATE_LIMIT_MAX_IPS:
+            self.rate_limit.popitem(last=False)
+        return limited
+
+    def purge_rate_limit(self, now: float):
+        if self.cfg.rate_limit_window <= 0:
+            return
+        cutoff = int(now // self.cfg.rate_limit_window) - 1
+        while self.rate_limit:
+            ip, (_, _, idx) = next(iter(self.rate_limit.items()))
+            if idx >= cutoff:
+                break
+            del self.rate_limit[ip]
 
     def gen_room_id(self) -> str:
-        return "".join(random.choice(ROOM_ID_ALPHABET) for _ in range(6))
+        return "".join(random.choices(ROOM_ID_ALPHABET, k=6))
 
-    async def create_room(self, sender: Connection) -> Optional[Room]:
-        async with self.rooms_lock:
-            if len(self.rooms) >= self.cfg.max_rooms:
-                return None
-            for _ in range(100):
-                rid = self.gen_room_id()
-                if rid not in self.rooms:
-                    room = Room(room_id=rid, sender=sender, created_at=time.time())
-                    self.rooms[rid] = room
-                    return room
+    def create_room(self, sender: Connection) -> Optional[Room]:
+        if len(self.rooms) >= self.cfg.max_rooms:
+            return None
+        for _ in range(100):
+            rid = self.gen_room_id()
+            if rid not in self.rooms:
+                room = Room(room_id=rid, sender=sender, created_at=asyncio.get_running_loop().time())
+                self.rooms[rid] = room
+                expires_at = room.created_at + self.cfg.room_ttl
+                heapq.heappush(self._expiry_heap, (expires_at, rid))
+                if expires_at < self._next_wake:
+                    self._expiry_wakeup.set()
+                return room
         return None
 
-    async def get_room(self, room_id: str) -> Optional[Room]:
-        async with self.rooms_lock:
-            room = self.rooms.get(room_id)
-            if not room:
-                return None
-            if room.closed or (time.time() - room.created_at > self.cfg.room_ttl):
-                return None
-            return room
+    def get_room(self, room_id: str) -> Optional[Room]:
+        room = self.rooms.get(room_id)
+        if not room:
+            return None
+        if room.closed or (asyncio.get_running_loop().time() - room.created_at > self.cfg.room_ttl):
+            return None
+        return room
 
-    async def remove_room(self, room_id: str):
-        async with self.rooms_lock:
-            self.rooms.pop(room_id, None)
+    def remove_room(self, room_id: str):
+        self.rooms.pop(room_id, None)
 
     async def close_room(self, room: Room, notify_waiters: bool = True):
         if room.closed:
             return
         room.closed = True
-        await self.remove_room(room.room_id)
+        room.has_waiter.set()
+        self.remove_room(room.room_id)
 
         if room.active_receiver:
             await self.close_conn(room.active_receiver)
             room.active_receiver.relay_done.set()
 
         if notify_waiters:
-            while not room.receiver_queue.empty():
-                try:
-                    queued = room.receiver_queue.get_nowait()
-                except asyncio.QueueEmpty:
-                    break
-                await self.send_json(queued, {"type": "ERROR", "reason": "sender_disconnected"})
+            while room.pending:
+                queued = room.pending.popleft()
+                await self.send_raw(queued, ERR_SENDER_DISCONNECTED)
                 queued.relay_done.set()
                 await self.close_conn(queued)
 
         await self.close_conn(room.sender)
 
     async def _forward_until_closed(self, src: Connection, dst: Connection, label: str):
+        recv = src.ws.recv
+        send = dst.ws.send
         try:
             while True:
-                msg = await src.ws.recv()
-                size = len(msg) if isinstance(msg, bytes) else len(msg.encode("utf-8"))
-                if size <= 0 or size > self.cfg.max_msg_size:
+                # Oversize frames are rejected by the library (serve max_size).
+                msg = await recv()
+                if not msg:
                     raise ConnectionError("invalid_message_size")
-                await dst.ws.send(msg)
+                await send(msg)
         except (ConnectionClosed, ConnectionError, OSError):
             pass
         except asyncio.CancelledError:
@@ -242,18 +312,31 @@ class RelayServer:
             except asyncio.CancelledError:
                 pass
 
+    async def next_receiver(self, room: Room) -> Optional[Connection]:
+        """Wait for a queued receiver; returns None if the sender closes first."""
+        while not room.pending:
+            if room.closed or room.sender.closed.is_set():
+                return None
+            room.has_waiter.clear()
+            # close_room sets has_waiter too, so this also wakes on sender close.
+            await room.has_waiter.wait()
+        return room.pending.popleft()
+
     async def sender_loop(self, room: Room):
         sender = room.sender
         try:
             while not room.closed:
-                receiver = await room.receiver_queue.get()
+                receiver = await self.next_receiver(room)
+                if receiver is None:
+                    await self.close_room(room)
+                    break
                 if room.closed:
                     receiver.relay_done.set()
                     await self.close_conn(receiver)
                     break
 
                 room.active_receiver = receiver
-                ok = await self.send_json(sender, {"type": "PEER_JOINED", "peer_id": receiver.conn_id})
+                ok = await self.send_raw(sender, peer_joined_msg(receiver.conn_id))
                 if not ok:
                     await self.close_conn(receiver)
                     receiver.relay_done.set()
@@ -272,7 +355,7 @@ class RelayServer:
                     await self.close_room(room)
                     break
 
-                ok = await self.send_json(sender, {"type": "PEER_DISCONNECTED", "peer_id": receiver.conn_id})
+                ok = await self.send_raw(sender, peer_disconnected_msg(receiver.conn_id))
                 if not ok:
                     await self.close_room(room)
                     break
@@ -280,53 +363,61 @@ class RelayServer:
             if not room.closed:
                 await self.close_room(room)
 
-    async def monitor_sender_disconnect(self, room: Room):
-        await room.sender.closed.wait()
-        if not room.closed:
-            await self.close_room(room)
-
     async def handle_create_room(self, conn: Connection, peer_ip: str):
-        room = await self.create_room(conn)
+        room = self.create_room(conn)
         if not room:
             await self.stats.record_event("create_room_rejected", peer_ip=peer_ip, reason="too_many_rooms")
-            await self.send_json(conn, {"type": "ERROR", "reason": "too_many_rooms"})
+            await self.send_raw(conn, ERR_TOO_MANY_ROOMS)
             await self.close_conn(conn)
             return
 
         await self.stats.record_event("room_created", peer_ip=peer_ip, room_id=room.room_id)
-        await self.send_json(conn, {"type": "ROOM_CREATED", "room_id": room.room_id})
-
-        sender_task = asyncio.create_task(self.sender_loop(room))
-        monitor_task = asyncio.create_task(self.monitor_sender_disconnect(room))
+        await self.send_raw(conn, room_created_msg(room.room_id))
 
         try:
-            await sender_task
+            await self.sender_loop(room)
         finally:
-            monitor_task.cancel()
             await self.close_room(room)
 
     async def handle_join_room(self, conn: Connection, room_id: str, peer_ip: str):
-        if not room_id or len(room_id) != 6 or any(c not in ROOM_ID_ALPHABET for c in room_id):
+        if not is_valid_room_id(room_id):
             await self.stats.record_event("join_room_rejected", peer_ip=peer_ip, reason="room_not_found")
-            await self.send_json(conn, {"type": "ERROR", "reason": "room_not_found"})
+            await self.send_raw(conn, ERR_ROOM_NOT_FOUND)
             await self.close_conn(conn)
             return
 
-        room = await self.get_room(room_id)
+        room = self.get_room(room_id)
         if not room or room.closed:
             await self.stats.record_event("join_room_rejected", peer_ip=peer_ip, room_id=room_id, reason="room_not_found")
-            await self.send_json(conn, {"type": "ERROR", "reason": "room_not_found"})
+            await self.send_raw(conn, ERR_ROOM_NOT_FOUND)
             await self.close_conn(conn)
             return
 
-        ok = await self.send_json(conn, {"type": "ROOM_JOINED", "room_id": room.room_id})
-        if not ok:
-            await self.stats.record_event("join_room_rejected", peer_ip=peer_ip, room_id=room_id, reason="send_failed")
+        if len(room.pending) + room.reserved >= self.cfg.max_waiters:
+            await self.stats.record_event("join_room_rejected", peer_ip=peer_ip, room_id=room_id, reason="room_busy")
+            await self.send_raw(conn, ERR_ROOM_BUSY)
             await self.close_conn(conn)
             return
 
-        await self.stats.record_event("room_joined", peer_ip=peer_ip, room_id=room_id)
-        await room.receiver_queue.put(conn)
+        # Hold the slot across the awaits below so concurrent joins see it taken.
+        room.reserved += 1
+        try:
+            ok = await self.send_raw(conn, room_joined_msg(room.room_id))
+            if not ok:
+                await self.stats.record_event("join_room_rejected", peer_ip=peer_ip, room_id=room_id, reason="send_failed")
+                await self.close_conn(conn)
+                return
+
+            await self.stats.record_event("room_joined", peer_ip=peer_ip, room_id=room_id)
+        finally:
+            room.reserved -= 1
+        if room.closed:
+            # close_room already drained pending; nothing would release this join.
+            await self.send_raw(conn, ERR_SENDER_DISCONNECTED)
+            await self.close_conn(conn)
+            return
+        room.pending.append(conn)
+        room.has_waiter.set()
         await conn.relay_done.wait()
         await self.close_conn(conn)
 
@@ -337,16 +428,16 @@ class RelayServer:
         peer_ip = peer[0] if isinstance(peer, tuple) and peer else "unknown"
 
         try:
-            if await self.is_rate_limited(peer_ip):
+            if self.is_rate_limited(peer_ip, asyncio.get_running_loop().time()):
                 await self.stats.record_event("request_rejected", peer_ip=peer_ip, reason="rate_limited")
-                await self.send_json(conn, {"type": "ERROR", "reason": "rate_limited"})
+                await self.send_raw(conn, ERR_RATE_LIMITED)
                 await self.close_conn(conn)
                 return
 
             msg = await self.recv_json(conn)
             if not isinstance(msg, dict):
                 await self.stats.record_event("request_rejected", peer_ip=peer_ip, reason="invalid_request")
-                await self.send_json(conn, {"type": "ERROR", "reason": "invalid_request"})
+                await self.send_raw(conn, ERR_INVALID_REQUEST)
                 await self.close_conn(conn)
                 return
 
@@ -358,23 +449,39 @@ class RelayServer:
                 await self.handle_join_room(conn, str(msg.get("room_id", "")), peer_ip)
             else:
                 await self.stats.record_event("request_rejected", peer_ip=peer_ip, reason="invalid_type", type=str(msg_type))
-                await self.send_json(conn, {"type": "ERROR", "reason": "invalid_request"})
+                await self.send_raw(conn, ERR_INVALID_REQUEST)
                 await self.close_conn(conn)
         finally:
             conn.closed.set()
 
     async def cleanup_expired_rooms(self):
+        loop = asyncio.get_running_loop()
+        heap = self._expiry_heap
         while True:
-            await asyncio.sleep(60)
-            now = time.time()
+            delay = 60.0
+            if heap:
+                delay = min(delay, max(heap[0][0] - loop.time(), 0.0))
+            self._next_wake = loop.time() + delay
+            self._expiry_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._expiry_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            now = loop.time()
             expired: list[Room] = []
-            async with self.rooms_lock:
-                for room in list(self.rooms.values()):
-                    if now - room.created_at > self.cfg.room_ttl:
-                        expired.append(room)
+            while heap and heap[0][0] <= now:
+                _, rid = heapq.heappop(heap)
+                room = self.rooms.get(rid)
+                # The id may have been reused by a newer room.
+                if room and now - room.created_at >= self.cfg.room_ttl:
+                    expired.append(room)
+            if len(heap) > 2 * len(self.rooms) + 64:
+                heap[:] = [entry for entry in heap if entry[1] in self.rooms]
+                heapq.heapify(heap)
             for room in expired:
                 if not room.closed:
                     await self.close_room(room)
+            self.purge_rate_limit(now)
 
     async def serve(self):
         print(f"Relay (WebSocket) listening on ws://{self.cfg.host}:{self.cfg.port}")
@@ -397,6 +504,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--max-msg-size", type=int, default=cfg.max_msg_size)
     parser.add_argument("--rate-limit-max", type=int, default=cfg.rate_limit_max)
     parser.add_argument("--rate-limit-window", type=int, default=cfg.rate_limit_window)
+    parser.add_argument("--max-waiters", type=int, default=cfg.max_waiters)
     parser.add_argument("--log-dir", type=str, default=cfg.log_dir)
     return parser.parse_args()
 
@@ -411,10 +519,14 @@ def main():
         max_msg_size=args.max_msg_size,
         rate_limit_max=args.rate_limit_max,
         rate_limit_window=args.rate_limit_window,
+        max_waiters=args.max_waiters,
         log_dir=args.log_dir,
     )
     server = RelayServer(cfg)
-    asyncio.run(server.serve())
+    if uvloop is not None:
+        uvloop.run(server.serve())
+    else:
+        asyncio.run(server.serve())
 
 
 if __name__ == "__main__":